@@ -1,114 +1,337 @@
 import streamlit as st
-import geopandas as gpd
-from geopy.geocoders import Nominatim
-from shapely.geometry import Point
+from geopy.adapters import RequestsAdapter
+from geopy.extra.rate_limiter import RateLimiter
+from geopy.geocoders import Nominatim, Pelias
+import numpy as np
 import pandas as pd
+import pyogrio
 import time
 import os
+import shelve
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlparse
 import pathlib
+from region_lookup import init_worker, run_containment_for_path
 
 # Add title and description
 st.title('Address Region Checker')
 st.write('Upload a CSV file with addresses to check which regions they fall into.')
 
-def get_coordinates(address):
-    """Convert address to coordinates using Nominatim geocoder"""
-    try:
-        geolocator = Nominatim(user_agent="my_geocoder")
-        location = geolocator.geocode(address)
-        if location:
-            return Point(location.longitude, location.latitude)
-        return None
-    except Exception as e:
-        st.error(f"Error geocoding address: {e}")
-        return None
+def parse_server_url(base_url):
+    """
+    Split a geocoding server URL into the domain and scheme geopy expects
+    
+    Raises:
+    ValueError: If the URL is not an http(s) URL with a host
+    """
+    url = urlparse(base_url.strip())
+    # 'localhost:8080' parses with 'localhost' as the scheme, so require both parts explicitly
+    if url.scheme not in ('http', 'https') or not url.netloc:
+        raise ValueError(f"Geocoder URL must start with http:// or https:// and include a host, e.g. http://localhost:8080 (got '{base_url}')")
+    return url.netloc + url.path.rstrip('/'), url.scheme
+
+class Geocoder:
+    """Geocoding backend that converts batches of addresses into (longitude, latitude) pairs"""
+    # Number of addresses handed to geocode_many at once, and requests kept in flight per batch
+    batch_size = 8
+    max_workers = 8
+    # Identifies the backend and server in the geocoding cache
+    cache_id = None
+    
+    def __init__(self, geolocator, min_delay_seconds):
+        # One geopy client per backend so its HTTP session and connection are reused across requests
+        self.geolocator = geolocator
+        # The rate limiter is thread-safe, paces all workers to the server's request rate and
+        # retries transient failures
+        self.rate_limited_geocode = RateLimiter(
+            geolocator.geocode,
+            min_delay_seconds=min_delay_seconds,
+            max_retries=2,
+            error_wait_seconds=5.0,
+            swallow_exceptions=False
+        )
+    
+    def geocode(self, address):
+        """Return the (longitude, latitude) of one address, or None if it can't be found"""
+        location = self.rate_limited_geocode(address)
+        return (location.longitude, location.latitude) if location else None
+    
+    def geocode_many(self, addresses):
+        """
+        Geocode a batch of addresses concurrently, returning results in the same order
+        
+        Returns:
+        list: (longitude, latitude) or None per address, or the exception raised for an
+        address that still failed after retries, so one failure doesn't discard the batch
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.geocode_or_error, addresses))
+    
+    def geocode_or_error(self, address):
+        """Geocode one address, returning the exception instead of raising it"""
+        try:
+            return self.geocode(address)
+        except Exception as e:
+            return e
+
+class NominatimGeocoder(Geocoder):
+    """Public Nominatim server, limited by its usage policy to one request per second"""
+    cache_id = "nominatim:public"
+    
+    def __init__(self):
+        super().__init__(
+            Nominatim(user_agent="my_geocoder", adapter_factory=RequestsAdapter),
+            min_delay_seconds=1
+        )
+
+class LocalNominatimGeocoder(Geocoder):
+    """Self-hosted Nominatim server (e.g. a Docker container), which has no request rate limit"""
+    batch_size = 100
+    max_workers = 32
+    
+    def __init__(self, base_url):
+        # Always name the server explicitly; falling back to the public one would send it
+        # unthrottled concurrent requests
+        domain, scheme = parse_server_url(base_url)
+        self.cache_id = f"nominatim:{scheme}://{domain}"
+        super().__init__(
+            Nominatim(user_agent="my_geocoder", domain=domain, scheme=scheme, adapter_factory=RequestsAdapter),
+            min_delay_seconds=0
+        )
+
+class BulkPeliasGeocoder(Geocoder):
+    """Pelias server or hosted Pelias API, which accepts large batches of concurrent requests"""
+    batch_size = 100
+    max_workers = 32
+    
+    def __init__(self, base_url, api_key=None):
+        domain, scheme = parse_server_url(base_url)
+        self.cache_id = f"pelias:{scheme}://{domain}"
+        super().__init__(
+            Pelias(domain=domain, api_key=api_key or None, scheme=scheme, adapter_factory=RequestsAdapter),
+            min_delay_seconds=0
+        )
+
+GEOCODER_BACKENDS = ["Nominatim (public)", "Nominatim (self-hosted)", "Pelias"]
+
+@st.cache_resource
+def get_geocoder(backend, base_url=None, api_key=None):
+    """Create the geocoder for the selected backend, shared across reruns and sessions"""
+    if backend == "Nominatim (self-hosted)":
+        return LocalNominatimGeocoder(base_url)
+    if backend == "Pelias":
+        return BulkPeliasGeocoder(base_url, api_key)
+    return NominatimGeocoder()
+
+# Geocoding results persist across sessions so repeated addresses never hit the geocoder twice
+GEOCODE_CACHE_DIR = pathlib.Path.home() / '.cache' / 'address-region-checker'
+GEOCODE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+GEOCODE_CACHE_PATH = str(GEOCODE_CACHE_DIR / 'geocode')
+
+@st.cache_resource
+def get_geocode_cache_lock():
+    """Return one lock for the cache file shared by every rerun and session"""
+    return threading.Lock()
 
-def check_address_in_region(address, regions_list):
+# shelve is not thread-safe, and Streamlit serves each session from its own thread
+geocode_cache_lock = get_geocode_cache_lock()
+
+def normalize_address(address):
+    """Collapse whitespace and case so equivalent addresses share one cache entry"""
+    return ' '.join(str(address).split()).lower()
+
+def not_found_key(cache_id, key):
+    """Cache key recording that one geocoder backend couldn't find a normalized address"""
+    return f"{cache_id}|{key}"
+
+def read_cached_coordinates(keys, cache_id):
     """
-    Check if an address falls within any region in any of the shapefiles
+    Return the cached result of every normalized address already geocoded
+    
+    Coordinates found by any backend are shared, but an address only counts as not found
+    if the given backend failed to find it, so switching backends re-queries earlier misses
+    """
+    cached = {}
+    with geocode_cache_lock, shelve.open(GEOCODE_CACHE_PATH) as shelf:
+        for key in keys:
+            coords = shelf.get(key)
+            if coords is not None:
+                cached[key] = coords
+            elif not_found_key(cache_id, key) in shelf:
+                cached[key] = None
+    return cached
+
+def write_cached_coordinates(coords_by_key, cache_id):
+    """Store freshly geocoded (longitude, latitude) pairs, and misses for the given backend"""
+    with geocode_cache_lock, shelve.open(GEOCODE_CACHE_PATH) as shelf:
+        for key, coords in coords_by_key.items():
+            if coords is None:
+                shelf[not_found_key(cache_id, key)] = None
+            else:
+                shelf[key] = coords
+
+def clear_geocoding_cache():
+    """Drop every cached geocoding result"""
+    with geocode_cache_lock, shelve.open(GEOCODE_CACHE_PATH) as shelf:
+        shelf.clear()
+
+@st.cache_resource
+def get_process_pool(n_shapefiles):
+    """
+    Start the region lookup worker processes once, reusing them across reruns and sessions
+    
+    Workers load a shapefile the first time they match against it and keep it for later runs,
+    so each run only sends them the point coordinates
+    """
+    cpu_count = os.cpu_count() or 1
+    max_workers = min(n_shapefiles, cpu_count)
+    # Spawned workers import only region_lookup, never this Streamlit script
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        # Split the cores between workers so numba's parallel kernel doesn't oversubscribe them
+        initializer=init_worker,
+        initargs=(max(1, cpu_count // max_workers),)
+    )
+
+@st.cache_resource
+def get_in_process_paths():
+    """Shapefiles whose worker died while matching them, matched in-process from then on"""
+    return set()
+
+def check_addresses_in_regions(xs, ys, shapefile_paths, index=None):
+    """
+    Check which region of each shapefile every geocoded point falls within
     
     Parameters:
-    address (str): The address to check
-    regions_list (list): List of tuples (file_name, GeoDataFrame) containing all region data
+    xs (ndarray): Longitudes of the geocoded addresses in EPSG:4326, NaN where geocoding failed
+    ys (ndarray): Latitudes of the geocoded addresses in EPSG:4326, NaN where geocoding failed
+    shapefile_paths (list): Paths of the shapefiles to match against
+    index (Index): Index for the returned frame, one entry per address
     
     Returns:
-    dict: Combined region attributes if found, None if not found
+    DataFrame: Prefixed region attributes plus an 'in_region' flag, one row per address
     """
-    point = get_coordinates(address)
-    if point is None:
-        return None
+    matches = {}
+    in_process_paths = get_in_process_paths()
+    pool_paths = [path for path in shapefile_paths if path not in in_process_paths]
+    if len(pool_paths) > 1:
+        # Shapefiles are independent, so they're matched in parallel worker processes
+        pool = get_process_pool(len(shapefile_paths))
+        futures = {path: pool.submit(run_containment_for_path, path, xs, ys) for path in pool_paths}
+        for path, future in futures.items():
+            try:
+                matches[path] = future.result()
+            except BrokenProcessPool:
+                # A worker died (e.g. out of memory loading this shapefile), so stop sending it
+                # to the pool rather than killing a fresh worker on every run
+                in_process_paths.add(path)
+        if len(matches) < len(futures):
+            # Stop the broken pool's remaining processes and drop it for the next run to start
+            # a fresh one; the shapefiles it didn't finish are matched in-process below
+            pool.shutdown(wait=False, cancel_futures=True)
+            get_process_pool.clear()
     
-    point_gdf = gpd.GeoDataFrame(geometry=[point], crs="EPSG:4326")
-    combined_data = {}
+    # Shapefiles are only loaded into this process when they're matched here
+    for path in shapefile_paths:
+        if path not in matches:
+            matches[path] = run_containment_for_path(path, xs, ys)
     
-    for file_path, regions in regions_list:
-        if regions.crs != point_gdf.crs:
-            regions = regions.to_crs(point_gdf.crs)
-        
-        # Get parent folder and file name for prefix
-        parts = pathlib.Path(file_path).parts
-        shape_files_idx = parts.index('shape_files')
-        prefix = '_'.join(parts[shape_files_idx + 1:]).replace('.shp', '')
-        
-        for idx, region in regions.iterrows():
-            if point.within(region.geometry):
-                region_dict = region.to_dict()
-                for key, value in region_dict.items():
-                    if key != 'geometry':
-                        combined_data[f"{prefix}_{key}"] = value
+    results = {}
+    in_region = np.zeros(len(xs), dtype=bool)
+    for path in shapefile_paths:
+        columns, matched = matches[path]
+        results.update(columns)
+        in_region |= matched
     
-    return combined_data if combined_data else None
+    results['in_region'] = in_region
+    # Build the frame from whole columns in one go instead of inserting them one at a time
+    return pd.DataFrame(results, index=index)
 
-def process_addresses(df, regions_list):
-    """Modified to work with multiple shapefiles"""
-    # Create empty columns for each attribute from all shapefiles
-    all_columns = []
-    for file_path, regions in regions_list:
-        # Get parent folder and file name for prefix
-        parts = pathlib.Path(file_path).parts
-        shape_files_idx = parts.index('shape_files')
-        prefix = '_'.join(parts[shape_files_idx + 1:]).replace('.shp', '')
-        
-        region_columns = [col for col in regions.columns if col != 'geometry']
-        for col in region_columns:
-            column_name = f"{prefix}_{col}"
-            df[column_name] = None
-            all_columns.append(column_name)
-    
-    df['in_region'] = False
-    
+def process_addresses(df, shapefile_paths, geocoder):
+    """Geocode every address, then match all points against each shapefile at once"""
     # Create a progress bar and status elements
     progress_bar = st.progress(0)
     status_text = st.empty()
     time_text = st.empty()
     
-    # Process each address
-    total_rows = len(df)
+    # Geocode each address
     start_time = time.time()
     
-    for idx, row in enumerate(df.iterrows()):
+    # Blank addresses are skipped and duplicates share one key, so each distinct address is
+    # looked up once; only the ones missing from the cache go to the geocoder
+    keys = [normalize_address(address) if pd.notna(address) else '' for address in df['address'].to_numpy()]
+    unique_keys = list(dict.fromkeys(key for key in keys if key))
+    coords_by_key = read_cached_coordinates(unique_keys, geocoder.cache_id)
+    missing = [key for key in unique_keys if key not in coords_by_key]
+    total_missing = len(missing)
+    
+    # Only redraw progress when the percentage or elapsed second changes, since every
+    # update is a round trip to the browser
+    last_pct = -1
+    last_sec = 0
+    failures = []
+    skipped = 0
+    
+    for idx in range(0, total_missing, geocoder.batch_size):
         # Calculate time estimates
         elapsed_time = time.time() - start_time
-        if idx > 0:
+        if idx > 0 and int(elapsed_time) != last_sec:
+            last_sec = int(elapsed_time)
             avg_time_per_row = elapsed_time / idx
-            estimated_remaining = avg_time_per_row * (total_rows - idx)
+            estimated_remaining = avg_time_per_row * (total_missing - idx)
             
             elapsed_str = time.strftime('%M:%S', time.gmtime(elapsed_time))
             remaining_str = time.strftime('%M:%S', time.gmtime(estimated_remaining))
             
             time_text.text(f"Elapsed: {elapsed_str} | Estimated remaining: {remaining_str}")
         
-        status_text.text(f"Processing address {idx + 1} of {total_rows}")
-        progress_bar.progress(idx / total_rows)
+        pct = int(idx * 100 / total_missing)
+        if pct != last_pct:
+            last_pct = pct
+            status_text.text(f"Geocoding address {idx + 1} of {total_missing} ({len(unique_keys) - total_missing} cached)")
+            progress_bar.progress(pct / 100)
         
-        region_data = check_address_in_region(row[1]['address'], regions_list)
+        batch = missing[idx:idx + geocoder.batch_size]
+        batch_coords = {}
+        batch_failures = []
+        for key, result in zip(batch, geocoder.geocode_many(batch)):
+            # Failed addresses are left uncached so the next run retries them
+            if isinstance(result, Exception):
+                batch_failures.append((key, result))
+            else:
+                batch_coords[key] = result
         
-        if region_data:
-            df.at[idx, 'in_region'] = True
-            for col, value in region_data.items():
-                df.at[idx, col] = value
+        write_cached_coordinates(batch_coords, geocoder.cache_id)
+        coords_by_key.update(batch_coords)
+        failures.extend(batch_failures)
         
-        time.sleep(1)
+        # A batch where every address failed means the geocoder is down or misconfigured, so
+        # stop instead of waiting through the retries for every remaining address
+        if batch_failures and len(batch_failures) == len(batch):
+            skipped = total_missing - idx - len(batch)
+            break
+    
+    # Report failures once rather than once per address
+    if failures:
+        examples = ', '.join(f"'{key}'" for key, _ in failures[:3])
+        message = f"❌ Could not geocode {len(failures)} address(es), e.g. {examples}. Last error: {failures[-1][1]}"
+        if skipped:
+            message += f" Stopped after a whole batch failed; {skipped} address(es) were not tried. Check the geocoder settings."
+        st.error(message)
+    
+    # Keep coordinates as two flat float arrays rather than one Point object per address
+    coords = [coords_by_key.get(key) or (np.nan, np.nan) for key in keys]
+    xs = np.asarray([lon for lon, lat in coords], dtype=np.float64)
+    ys = np.asarray([lat for lon, lat in coords], dtype=np.float64)
+    
+    # Match all geocoded points against the regions at once
+    status_text.text("Matching addresses to regions...")
+    region_data = check_addresses_in_regions(xs, ys, shapefile_paths, index=df.index)
+    df = pd.concat([df.drop(columns=region_data.columns, errors='ignore'), region_data], axis=1)
     
     # Final progress update
     progress_bar.progress(1.0)
@@ -118,6 +341,11 @@ def process_addresses(df, regions_list):
     
     return df
 
+@st.cache_data
+def get_feature_count(path):
+    """Count the features in a shapefile from its header, without reading any geometries"""
+    return pyogrio.read_info(path)['features']
+
 def find_shapefiles(directory="shape_files"):
     """Recursively find all .shp files in the given directory"""
     shapefile_paths = []
@@ -158,6 +386,29 @@ with st.sidebar:
         st.session_state.clear()
         st.rerun()
     
+    # Add Clear Cache button to sidebar
+    if st.button("🗑️ Clear Geocoding Cache", use_container_width=True):
+        clear_geocoding_cache()
+        st.success("Geocoding cache cleared")
+    st.write("---")
+    
+    # Let heavy users point at a geocoder without the public server's rate limit
+    st.header("Geocoder")
+    geocoder_backend = st.selectbox("Geocoding service", GEOCODER_BACKENDS)
+    try:
+        if geocoder_backend == "Nominatim (self-hosted)":
+            geocoder_url = st.text_input("Nominatim URL", "http://localhost:8080")
+            geocoder = get_geocoder(geocoder_backend, geocoder_url)
+        elif geocoder_backend == "Pelias":
+            geocoder_url = st.text_input("Pelias URL", "http://localhost:4000")
+            geocoder_api_key = st.text_input("API key (optional)", type="password")
+            geocoder = get_geocoder(geocoder_backend, geocoder_url, geocoder_api_key)
+        else:
+            geocoder = get_geocoder(geocoder_backend)
+    except ValueError as e:
+        st.error(f"❌ {e}")
+        geocoder = None
+    
     # Initialize session state if needed
     if 'current_step' not in st.session_state:
         st.session_state.current_step = 1
@@ -174,9 +425,7 @@ if SHAPEFILE_PATHS:
     with st.expander("View Available Shapefiles"):
         for path in SHAPEFILE_PATHS:
             relative_path = str(pathlib.Path(path)).split('shape_files/')[-1]
-            # Load the shapefile and get feature count
-            gdf = gpd.read_file(path)
-            feature_count = len(gdf)
+            feature_count = get_feature_count(path)
             st.text(f"{relative_path} ({feature_count:,} features)")
 
 # Step 1: File Upload
@@ -210,20 +459,15 @@ if uploaded_csv is not None:
             else:
                 step2_status.info("⏳ Ready to process")
             
-            # Read all shapefiles
             try:
-                regions_list = []
-                for shapefile_path in SHAPEFILE_PATHS:
-                    regions = gpd.read_file(shapefile_path)
-                    regions_list.append((shapefile_path, regions))
-                
                 # Make the process button more prominent
                 col1, col2, col3 = st.columns([1, 2, 1])
                 with col2:
                     process_button = st.button(
                         'Process Addresses',
                         use_container_width=True,
-                        type="primary"  # Makes the button more prominent
+                        type="primary",  # Makes the button more prominent
+                        disabled=geocoder is None
                     )
                 
                 if process_button or st.session_state.processing_complete:
@@ -232,7 +476,7 @@ if uploaded_csv is not None:
                         step3_status.info("⏳ Waiting for processing")
                         
                         # Process the addresses
-                        result_df = process_addresses(df, regions_list)
+                        result_df = process_addresses(df, SHAPEFILE_PATHS, geocoder)
                         
                         # Store results and state
                         st.session_state.result_df = result_df
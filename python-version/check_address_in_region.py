@@ -1,15 +1,24 @@
 import geopandas as gpd
+from geopy.extra.rate_limiter import RateLimiter
 from geopy.geocoders import Nominatim
 from shapely.geometry import Point
 import pandas as pd
-import time
 from tqdm import tqdm
 
+# Share one geocoder, paced to Nominatim's one request per second at the call site itself
+geolocator = Nominatim(user_agent="my_geocoder")
+geocode = RateLimiter(
+    geolocator.geocode,
+    min_delay_seconds=1,
+    max_retries=2,
+    error_wait_seconds=5.0,
+    swallow_exceptions=False
+)
+
 def get_coordinates(address):
     """Convert address to coordinates using Nominatim geocoder"""
     try:
-        geolocator = Nominatim(user_agent="my_geocoder")
-        location = geolocator.geocode(address)
+        location = geocode(address)
         if location:
             return Point(location.longitude, location.latitude)
         return None
@@ -17,35 +26,22 @@ def get_coordinates(address):
         print(f"Error geocoding address: {e}")
         return None
 
-def check_address_in_region(address, regions):
+def check_addresses_in_region(points_gdf, regions):
     """
-    Check if an address falls within any region in the shapefile
+    Check which region every geocoded point falls within
     
     Parameters:
-    address (str): The address to check
-    regions (GeoDataFrame): The loaded regions from shapefile
+    points_gdf (GeoDataFrame): Geocoded address points in EPSG:4326, one row per address
+    regions (GeoDataFrame): The loaded regions from shapefile, in EPSG:4326
     
     Returns:
-    dict: Region attributes if found, None if not found
+    GeoDataFrame: points_gdf joined with the attributes of the containing region
     """
-    # Get coordinates for the address
-    point = get_coordinates(address)
-    if point is None:
-        return None
-    
-    # Create a GeoDataFrame for the point
-    point_gdf = gpd.GeoDataFrame(geometry=[point], crs="EPSG:4326")
-    
-    # Ensure both geometries are using the same coordinate system
-    if regions.crs != point_gdf.crs:
-        regions = regions.to_crs(point_gdf.crs)
-    
-    # Check if point is within any region
-    for idx, region in regions.iterrows():
-        if point.within(region.geometry):
-            return region.to_dict()
+    # Spatial join uses the regions' spatial index instead of testing every region per point
+    joined = gpd.sjoin(points_gdf, regions, how='left', predicate='within')
     
-    return None
+    # A point inside overlapping regions keeps the first match, as the per-row loop did
+    return joined[~joined.index.duplicated(keep='first')]
 
 def process_addresses(csv_path, shapefile_path):
     """
@@ -63,27 +59,33 @@ def process_addresses(csv_path, shapefile_path):
     
     # Read the shapefile
     regions = gpd.read_file(shapefile_path)
+    
+    # Reproject once up front so the geocoded points and regions share a coordinate system
+    if regions.crs != "EPSG:4326":
+        regions = regions.to_crs("EPSG:4326")
     print("Available attributes:", list(regions.columns))
     
-    # Create empty columns for each attribute in the shapefile
+    # Geocode each distinct, non-blank address once with tqdm progress bar, then map the
+    # results back onto every row
+    addresses = df['address'].fillna('').astype(str).str.strip().to_numpy()
+    unique_addresses = [address for address in pd.unique(addresses) if address]
+    points_by_address = {
+        address: get_coordinates(address)
+        for address in tqdm(unique_addresses, desc="Processing addresses")
+    }
+    points = [points_by_address.get(address) for address in addresses]
+    
+    # Match all geocoded points against the regions at once
+    points_gdf = gpd.GeoDataFrame(geometry=points, index=df.index, crs="EPSG:4326")
+    joined = check_addresses_in_region(points_gdf, regions)
+    
+    # Add the attributes of each shapefile region
     region_columns = [col for col in regions.columns if col != 'geometry']
     for col in region_columns:
-        df[f'region_{col}'] = None
+        df[f'region_{col}'] = joined[col]
     
     # Add a column to track if address was found in any region
-    df['in_region'] = False
-    
-    # Process each address with tqdm progress bar
-    for idx, row in tqdm(df.iterrows(), total=len(df), desc="Processing addresses"):
-        region_data = check_address_in_region(row['address'], regions)
-        
-        if region_data:
-            df.at[idx, 'in_region'] = True
-            for col in region_columns:
-                df.at[idx, f'region_{col}'] = region_data[col]
-        
-        # Add a small delay to avoid overwhelming the geocoding service
-        time.sleep(1)
+    df['in_region'] = joined['index_right'].notna()
     
     # Save the results to a new CSV file
     output_path = csv_path.rsplit('.', 1)[0] + '_with_regions.csv'
@@ -0,0 +1,213 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pathlib
+import shapely
+from collections import namedtuple
+from shapely.strtree import STRtree
+
+try:
+    from numba import njit, prange, set_num_threads
+except ImportError:
+    njit = None
+
+# Everything here is importable without Streamlit so worker processes can unpickle it
+
+# Shapefiles already loaded by this process, so a worker reads and indexes each one only once
+loaded_records = {}
+
+# A shapefile with everything the region lookup needs, computed once at load time
+ShapefileRecord = namedtuple(
+    'ShapefileRecord',
+    ['path', 'prefix', 'attr_cols', 'tree', 'prepared_geoms', 'attrs', 'hull', 'bounds']
+)
+
+# Shapefiles with at most this many regions skip the tree and scan a flat array of bounding boxes
+BBOX_SCAN_MAX_REGIONS = 64
+# Points compared per chunk in the bounding box scan, capping its (points x regions) mask
+BBOX_SCAN_CHUNK_SIZE = 4096
+# Polygons tested against at least this many points, with at least this many vertices, use the
+# compiled ray-casting kernel when numba is installed; below that, JIT warmup outweighs the gain
+RAY_CAST_MIN_POINTS = 10000
+RAY_CAST_MIN_VERTICES = 1000
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def ray_cast_contains(xs, ys, ring_xs, ring_ys, ring_starts):
+        """Even-odd ray cast of each point across all rings, so holes and separate parts both work"""
+        inside = np.zeros(len(xs), dtype=np.bool_)
+        for i in prange(len(xs)):
+            x = xs[i]
+            y = ys[i]
+            crossings = False
+            for r in range(len(ring_starts) - 1):
+                j = ring_starts[r + 1] - 1
+                for k in range(ring_starts[r], ring_starts[r + 1]):
+                    if (ring_ys[k] > y) != (ring_ys[j] > y):
+                        if x < (ring_xs[j] - ring_xs[k]) * (y - ring_ys[k]) / (ring_ys[j] - ring_ys[k]) + ring_xs[k]:
+                            crossings = not crossings
+                    j = k
+            inside[i] = crossings
+        return inside
+
+def polygon_rings(geom):
+    """
+    Flatten the rings of a polygon or multipolygon into arrays for the ray-casting kernel
+    
+    Parameters:
+    geom (Polygon or MultiPolygon): The region geometry
+    
+    Returns:
+    tuple: Ring x coordinates, ring y coordinates and the offset where each ring starts
+    """
+    rings = shapely.get_rings(shapely.get_parts(geom))
+    coords, ring_idx = shapely.get_coordinates(rings, return_index=True)
+    ring_starts = np.searchsorted(ring_idx, np.arange(len(rings) + 1))
+    return np.ascontiguousarray(coords[:, 0]), np.ascontiguousarray(coords[:, 1]), ring_starts
+
+def contains_points(geom, xs, ys):
+    """
+    Test which points fall inside a region geometry
+    
+    Parameters:
+    geom (Geometry): The prepared region geometry
+    xs (ndarray): Longitudes of the points to test
+    ys (ndarray): Latitudes of the points to test
+    
+    Returns:
+    ndarray: Boolean array flagging the points inside geom
+    """
+    if (
+        njit is not None
+        and len(xs) >= RAY_CAST_MIN_POINTS
+        and shapely.get_num_coordinates(geom) >= RAY_CAST_MIN_VERTICES
+    ):
+        # Points exactly on an edge may land either way, unlike GEOS which excludes them
+        return ray_cast_contains(xs, ys, *polygon_rings(geom))
+    return shapely.contains_xy(geom, xs, ys)
+
+def load_shapefile(shapefile_path):
+    """
+    Read, reproject and index a shapefile for the region lookup
+    
+    Parameters:
+    shapefile_path (str): Path to the shapefile, somewhere under a 'shape_files' directory
+    
+    Returns:
+    ShapefileRecord: The indexed regions and their attributes
+    """
+    regions = gpd.read_file(shapefile_path)
+    # Reproject once at load time so lookups never have to
+    if regions.crs != "EPSG:4326":
+        regions = regions.to_crs("EPSG:4326")
+    # Index the regions once so each lookup only tests polygons whose bounding box holds the point
+    tree = STRtree(regions.geometry.values)
+    # Prepare the polygons once so GEOS reuses their edge index across every point test
+    prepared_geoms = np.asarray(regions.geometry.values)
+    shapely.prepare(prepared_geoms)
+    # Convex hull of every vertex covers the union of the regions without the cost of dissolving them
+    hull = shapely.convex_hull(shapely.multipoints(shapely.get_coordinates(prepared_geoms)))
+    shapely.prepare(hull)
+    # Bounding boxes as contiguous (minx, miny, maxx, maxy) rows for the flat scan
+    bounds = np.ascontiguousarray(shapely.bounds(prepared_geoms).T)
+    
+    # Get parent folder and file name for prefix
+    parts = pathlib.Path(shapefile_path).parts
+    shape_files_idx = parts.index('shape_files')
+    prefix = '_'.join(parts[shape_files_idx + 1:]).replace('.shp', '')
+    attr_cols = [col for col in regions.columns if col != 'geometry']
+    
+    # Keep each attribute's own dtype in the results rather than object; values repeat for
+    # every address in a region, so text attributes become categoricals
+    attrs = {}
+    for col in attr_cols:
+        values = regions[col]
+        if values.dtype == object or isinstance(values.dtype, pd.StringDtype):
+            attrs[col] = pd.Categorical(values)
+        else:
+            # Nullable integer and boolean types can hold NA for unmatched addresses
+            attrs[col] = values.convert_dtypes(convert_floating=False).array
+    
+    return ShapefileRecord(shapefile_path, prefix, attr_cols, tree, prepared_geoms, attrs, hull, bounds)
+
+def init_worker(num_threads):
+    """Limit numba's threads in a worker process so parallel workers share the cores"""
+    if njit is not None:
+        set_num_threads(num_threads)
+
+def get_shapefile(shapefile_path):
+    """Load a shapefile the first time this process needs it and reuse it afterwards"""
+    if shapefile_path not in loaded_records:
+        loaded_records[shapefile_path] = load_shapefile(shapefile_path)
+    return loaded_records[shapefile_path]
+
+def run_containment_for_path(shapefile_path, xs, ys):
+    """Worker entry point: run_containment against this process's copy of the shapefile"""
+    return run_containment(get_shapefile(shapefile_path), xs, ys)
+
+def find_candidates(rec, xs, ys, candidate_idx):
+    """
+    Find the (point, region) pairs whose region bounding box holds the point
+    
+    Parameters:
+    rec (ShapefileRecord): The shapefile to search
+    xs (ndarray): Longitudes of all addresses
+    ys (ndarray): Latitudes of all addresses
+    candidate_idx (ndarray): Positions of the addresses worth testing
+    
+    Returns:
+    tuple: Arrays of address positions and region positions, one entry per pair
+    """
+    if len(rec.prepared_geoms) > BBOX_SCAN_MAX_REGIONS:
+        point_idx, region_idx = rec.tree.query(shapely.points(xs[candidate_idx], ys[candidate_idx]))
+        return candidate_idx[point_idx], region_idx
+    
+    # For a handful of regions, four vectorized comparisons beat walking the tree
+    minx, miny, maxx, maxy = rec.bounds
+    point_parts = [np.empty(0, dtype=np.intp)]
+    region_parts = [np.empty(0, dtype=np.intp)]
+    for start in range(0, len(candidate_idx), BBOX_SCAN_CHUNK_SIZE):
+        chunk_idx = candidate_idx[start:start + BBOX_SCAN_CHUNK_SIZE]
+        x = xs[chunk_idx, None]
+        y = ys[chunk_idx, None]
+        point_i, region_i = np.nonzero((minx <= x) & (x <= maxx) & (miny <= y) & (y <= maxy))
+        point_parts.append(chunk_idx[point_i])
+        region_parts.append(region_i)
+    return np.concatenate(point_parts), np.concatenate(region_parts)
+
+def run_containment(rec, xs, ys):
+    """
+    Check which region of one shapefile every geocoded point falls within
+    
+    Parameters:
+    rec (ShapefileRecord): The shapefile to search
+    xs (ndarray): Longitudes of the addresses in EPSG:4326, NaN where geocoding failed
+    ys (ndarray): Latitudes of the addresses in EPSG:4326, NaN where geocoding failed
+    
+    Returns:
+    tuple: Dict of prefixed attribute columns and a boolean array flagging addresses in a region
+    """
+    geocoded_idx = np.flatnonzero(~np.isnan(xs) & ~np.isnan(ys))
+    # Points outside the shapefile's hull can't be in any of its regions, so reject them up front
+    candidate_idx = geocoded_idx[shapely.contains_xy(rec.hull, xs[geocoded_idx], ys[geocoded_idx])]
+    
+    # Bounding-box candidates, grouped by region
+    point_idx, region_idx = find_candidates(rec, xs, ys, candidate_idx)
+    order = np.argsort(region_idx, kind='stable')
+    point_idx, region_idx = point_idx[order], region_idx[order]
+    region_ids, starts = np.unique(region_idx, return_index=True)
+    
+    match_idx = np.full(len(xs), -1)
+    
+    # Regions are visited in file order, so a point inside overlapping regions keeps the last match
+    for region_i, candidates in zip(region_ids, np.split(point_idx, starts[1:])):
+        # Test every candidate point against the polygon in a single vectorized call
+        hits = candidates[contains_points(rec.prepared_geoms[region_i], xs[candidates], ys[candidates])]
+        match_idx[hits] = region_i
+    
+    # Unmatched addresses get NA in the attribute's own dtype
+    columns = {
+        f"{rec.prefix}_{col}": rec.attrs[col].take(match_idx, allow_fill=True)
+        for col in rec.attr_cols
+    }
+    return columns, match_idx >= 0